@@ -5,12 +5,17 @@
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
 import functools
+import logging
 
 from ..executor import DeviceState, InputModule, JittableExecutable
 from ..script_importer import ScriptImporter, make_simple_dynamo_backend
 
 import torch
 
+logger = logging.getLogger(__name__)
+
+_CPU_COMPILER_FLAGS = ("--iree-hal-target-backends=llvm-cpu",)
+
 
 # TODO: Work out the boxing/aot-autograd nonsense vs using this utility.
 @make_simple_dynamo_backend
@@ -18,12 +23,12 @@ def backend(gm: torch.fx.GraphModule, example_inputs):
     # print(example_inputs)
     imp = ScriptImporter(text_mode=True)
     input_module = InputModule(imp(gm, example_inputs))
-    print("INPUT MODULE:", input_module)
+    logger.debug("INPUT MODULE:\n%s", input_module)
     device_state = _get_device_state()
     exe = JittableExecutable(
         input_module,
         device_state,
-        compiler_flags=("--iree-hal-target-backends=llvm-cpu",),
+        compiler_flags=_CPU_COMPILER_FLAGS,
     )
     return exe
     # return gm.forward  # return a python callable
@@ -4,13 +4,19 @@
 # See https://llvm.org/LICENSE.txt for license information.
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
+import collections
 import functools
-from typing import List, Optional, Sequence, Union
+import logging
+import threading
+from typing import List, Optional, Sequence, Tuple, Union
 
+from ..support.compile_cache import get_default_compile_cache, get_toolchain_salt
 from ..support.compiler_api import Compiler, Pipeline
 
 import iree.runtime as rt
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_COMPILER_FLAGS = (
     # Enable asynchronous calling convention.
     "--iree-execution-model=async-external",
@@ -22,6 +28,36 @@ def get_vm_instance() -> rt.VmInstance:
     return rt.VmInstance()
 
 
+# Per-thread LRU of compiler flags -> Compiler. Each Compiler owns a full
+# compiler context, so only a few distinct flag sets are kept per thread.
+_compilers_tls = threading.local()
+_MAX_COMPILERS_PER_THREAD = 4
+
+
+def _get_compiler(compiler_flags: Tuple[str, ...]) -> Compiler:
+    """Returns a compiler session configured with `compiler_flags`.
+
+    Sessions hold the flag state and context setup that is common to all
+    invocations, so they are reused across compilations with the same flags.
+    Each thread gets its own sessions so that concurrent compilations neither
+    contend on nor race over a shared session.
+    """
+    try:
+        compilers = _compilers_tls.compilers
+    except AttributeError:
+        compilers = _compilers_tls.compilers = collections.OrderedDict()
+    compiler = compilers.get(compiler_flags)
+    if compiler is not None:
+        compilers.move_to_end(compiler_flags)
+        return compiler
+    compiler = Compiler()
+    compiler.set_flags(*compiler_flags)
+    compilers[compiler_flags] = compiler
+    if len(compilers) > _MAX_COMPILERS_PER_THREAD:
+        compilers.popitem(last=False)
+    return compiler
+
+
 class DeviceState:
     def __init__(
         self, *, driver: Union[str, rt.HalDriver], device: Optional[rt.HalDevice] = None
@@ -95,13 +131,25 @@ class JittableExecutable:
         self._default_spec = self._compile_default_spec()
 
     def __call__(self, *inputs):
-        print("Inputs:", inputs)
+        logger.debug("Inputs: %s", inputs)
         return self._default_spec(*inputs)
 
     def _compile_default_spec(self) -> SpecializedExecutable:
-        # TODO: Should be caching compiler instances.
-        compiler = Compiler()
-        compiler.set_flags(*self.compiler_flags)
+        cache = get_default_compile_cache()
+        if cache:
+            cache_key = cache.make_key(
+                self.input_module.module_bytecode,
+                self.compiler_flags,
+                get_toolchain_salt(),
+            )
+            cached_vmfb = cache.lookup(cache_key)
+            if cached_vmfb is not None:
+                vmfb_module = rt.VmModule.wrap_buffer(
+                    self.device_state.instance, cached_vmfb
+                )
+                return SpecializedExecutable(vmfb_module, self.device_state)
+
+        compiler = _get_compiler(self.compiler_flags)
         pipeline = compiler.load_buffer(
             self.input_module.module_bytecode, buffer_name="dynamo"
         )
@@ -110,9 +158,12 @@ class JittableExecutable:
         # Output to runtime.
         vmfb_output = compiler.open_output_membuffer()
         pipeline.output_vm_bytecode(vmfb_output)
+        vmfb_contents = vmfb_output.map_memory()
+        if cache:
+            cache.store(cache_key, vmfb_contents)
         vmfb_module = rt.VmModule.wrap_buffer(
             self.device_state.instance,
-            vmfb_output.map_memory(),
+            vmfb_contents,
             destroy_callback=vmfb_output.close,
         )
         return SpecializedExecutable(vmfb_module, self.device_state)
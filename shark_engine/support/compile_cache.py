@@ -0,0 +1,170 @@
+# Copyright 2023 Stella Laurenzo
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+"""Persistent on-disk cache of compiled VM bytecode."""
+
+from typing import Optional, Sequence
+
+import functools
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+
+from . import compiler_dl as dl
+
+__all__ = [
+    "CompileCache",
+    "get_default_compile_cache",
+]
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Temporary files older than this were left by a writer that died before
+# renaming them into place.
+_STALE_TMP_AGE_SECONDS = 60 * 60
+
+
+class CompileCache:
+    """A directory of compiled VM bytecode files, keyed by content hash.
+
+    Keys are derived from the input module, the compiler flags and a salt
+    identifying the compiler build, so that entries are invalidated when any
+    of them change. Entries are written atomically and can therefore be shared
+    between concurrent processes.
+
+    The total size of entries is bounded by `max_size` bytes: least recently
+    used entries (by mtime, which is refreshed on lookup) are evicted when a
+    new entry is stored.
+    """
+
+    def __init__(self, cache_dir: str, *, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(source, flags: Sequence[str], salt: str) -> str:
+        h = hashlib.sha256()
+        h.update(salt.encode())
+        h.update(b"\0")
+        for flag in flags:
+            h.update(flag.encode())
+            h.update(b"\0")
+        h.update(source)
+        return h.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.vmfb")
+
+    def lookup(self, key: str) -> Optional[mmap.mmap]:
+        """Returns a read-only mapping of the entry for `key` or None."""
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return contents
+
+    def store(self, key: str, contents) -> bool:
+        """Stores `contents` (any buffer) under `key`.
+
+        Returns whether the entry was written. Entries larger than `max_size`
+        are not written. Failures (e.g. a read-only cache directory) are
+        logged and otherwise ignored.
+        """
+        if memoryview(contents).nbytes > self.max_size:
+            logging.debug("Not caching oversized compile cache entry %s", key)
+            return False
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(contents)
+                path = self.get_path(key)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._evict(keep_path=path)
+        except OSError as e:
+            logging.debug("Could not write compile cache entry %s: %s", key, e)
+            return False
+        return True
+
+    def _evict(self, keep_path: str):
+        # `keep_path` is the entry just stored: it is never evicted, even if
+        # coarse mtimes make it look as old as everything else.
+        entries = []
+        total_size = 0
+        stale_tmp_mtime_ns = (time.time() - _STALE_TMP_AGE_SECONDS) * 1e9
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    try:
+                        if entry.stat().st_mtime_ns < stale_tmp_mtime_ns:
+                            os.unlink(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                if not entry.name.endswith(".vmfb"):
+                    continue
+                if entry.path == keep_path:
+                    try:
+                        total_size += entry.stat().st_size
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total_size += st.st_size
+        if total_size <= self.max_size:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # Removed concurrently or still mapped (on Windows).
+                continue
+            total_size -= size
+
+
+@functools.lru_cache(maxsize=None)
+def get_toolchain_salt() -> str:
+    """Returns a string identifying the compiler build in use."""
+    dylib_path = dl.get_dylib_path()
+    st = os.stat(dylib_path)
+    return f"{dylib_path}:{st.st_size}:{st.st_mtime_ns}"
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_compile_cache() -> Optional[CompileCache]:
+    """Returns the per-user compile cache.
+
+    The location can be overridden with SHARK_ENGINE_COMPILE_CACHE_DIR, and
+    setting it to an empty string disables caching.
+    """
+    cache_dir = os.environ.get("SHARK_ENGINE_COMPILE_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = os.path.join(dl.get_cache_dir(), "bytecode")
+    if not cache_dir:
+        return None
+    return CompileCache(cache_dir)
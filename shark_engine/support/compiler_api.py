@@ -8,7 +8,7 @@
 
 from contextlib import closing
 from pathlib import Path
-from typing import Sequence, Optional, Union
+from typing import FrozenSet, Sequence, Optional, Union
 
 from . import compiler_dl as dl
 
@@ -32,6 +32,9 @@ class Compiler:
     def get_flags(self) -> Sequence[str]:
         return self._session.get_flags()
 
+    def get_flags_set(self) -> FrozenSet[str]:
+        return self._session.get_flags_set()
+
     def load_buffer(self, buffer, *, buffer_name: Optional[str]) -> "Pipeline":
         """Opens a source backed by a buffer in memory."""
         source = dl.Source.wrap_buffer(self._session, buffer, buffer_name=buffer_name)
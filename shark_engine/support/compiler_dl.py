@@ -10,13 +10,18 @@
 
 from ctypes import *
 from enum import IntEnum
-from pathlib import Path
-from typing import List, Optional, Sequence
+from typing import FrozenSet, List, Optional, Sequence
 
+import atexit
 import ctypes
+import functools
+import hashlib
 import logging
 import os
 import platform
+import sys
+import tempfile
+import threading
 
 __all__ = [
     "Invocation",
@@ -26,9 +31,58 @@ __all__ = [
 ]
 
 _dylib = None
+_dylib_path = None
 
 _GET_FLAG_CALLBACK = CFUNCTYPE(None, c_void_p, c_size_t, c_void_p)
 
+# Raw flag bytes collected by the active get_flags call on this thread.
+_get_flags_tls = threading.local()
+
+
+@_GET_FLAG_CALLBACK
+def _get_flag_callback(flag_pointer, length, user_data):
+    _get_flags_tls.results.append(string_at(flag_pointer, length))
+
+
+# UTF-8 encodes strings that are likely to be passed repeatedly (buffer
+# names, file paths).
+_encode_cached = functools.lru_cache(maxsize=256)(str.encode)
+
+
+@functools.lru_cache(maxsize=128)
+def _encode_argv(flags: tuple) -> Array:
+    argv_type = c_char_p * len(flags)
+    return argv_type(*[flag.encode("UTF-8") for flag in flags])
+
+
+# libIREECompiler functions bound as module globals by _init_dylib().
+_ENTRY_POINTS = (
+    "ireeCompilerErrorDestroy",
+    "ireeCompilerErrorGetMessage",
+    "ireeCompilerGlobalInitialize",
+    "ireeCompilerGlobalShutdown",
+    "ireeCompilerInvocationCreate",
+    "ireeCompilerInvocationDestroy",
+    "ireeCompilerInvocationEnableConsoleDiagnostics",
+    "ireeCompilerInvocationParseSource",
+    "ireeCompilerInvocationPipeline",
+    "ireeCompilerInvocationOutputIR",
+    "ireeCompilerInvocationOutputVMBytecode",
+    "ireeCompilerOutputDestroy",
+    "ireeCompilerOutputOpenFile",
+    "ireeCompilerOutputOpenMembuffer",
+    "ireeCompilerOutputKeep",
+    "ireeCompilerOutputWrite",
+    "ireeCompilerOutputMapMemory",
+    "ireeCompilerSessionCreate",
+    "ireeCompilerSessionDestroy",
+    "ireeCompilerSessionGetFlags",
+    "ireeCompilerSessionSetFlags",
+    "ireeCompilerSourceDestroy",
+    "ireeCompilerSourceOpenFile",
+    "ireeCompilerSourceWrapBuffer",
+)
+
 
 def _setsig(f, restype, argtypes):
     f.restype = restype
@@ -36,62 +90,65 @@ def _setsig(f, restype, argtypes):
 
 
 def _init_dylib():
-    global _dylib
+    global _dylib, _dylib_path
     if _dylib:
         return
     dylib_path = _probe_iree_compiler_dylib()
     if dylib_path is None:
         # TODO: Look for a bundled dylib.
         raise RuntimeError("Could not find libIREECompiler.so")
-    _dylib = cdll.LoadLibrary(dylib_path)
+    # Note that this must be a CDLL (not a PyDLL): foreign calls then release
+    # the GIL, allowing long-running compilations to overlap with other
+    # Python threads.
+    dylib = cdll.LoadLibrary(dylib_path)
 
     # Setup signatures.
     # Error
-    _setsig(_dylib.ireeCompilerErrorDestroy, None, [c_void_p])
-    _setsig(_dylib.ireeCompilerErrorGetMessage, c_char_p, [c_void_p])
+    _setsig(dylib.ireeCompilerErrorDestroy, None, [c_void_p])
+    _setsig(dylib.ireeCompilerErrorGetMessage, c_char_p, [c_void_p])
 
     # Invocation
-    _setsig(_dylib.ireeCompilerInvocationCreate, c_void_p, [c_void_p])
-    _setsig(_dylib.ireeCompilerInvocationDestroy, None, [c_void_p])
-    _setsig(_dylib.ireeCompilerInvocationEnableConsoleDiagnostics, None, [c_void_p])
-    _setsig(_dylib.ireeCompilerInvocationParseSource, c_bool, [c_void_p, c_void_p])
-    _setsig(_dylib.ireeCompilerInvocationPipeline, c_bool, [c_void_p, c_int])
-    _setsig(_dylib.ireeCompilerInvocationOutputIR, c_void_p, [c_void_p, c_void_p])
+    _setsig(dylib.ireeCompilerInvocationCreate, c_void_p, [c_void_p])
+    _setsig(dylib.ireeCompilerInvocationDestroy, None, [c_void_p])
+    _setsig(dylib.ireeCompilerInvocationEnableConsoleDiagnostics, None, [c_void_p])
+    _setsig(dylib.ireeCompilerInvocationParseSource, c_bool, [c_void_p, c_void_p])
+    _setsig(dylib.ireeCompilerInvocationPipeline, c_bool, [c_void_p, c_int])
+    _setsig(dylib.ireeCompilerInvocationOutputIR, c_void_p, [c_void_p, c_void_p])
     _setsig(
-        _dylib.ireeCompilerInvocationOutputVMBytecode, c_void_p, [c_void_p, c_void_p]
+        dylib.ireeCompilerInvocationOutputVMBytecode, c_void_p, [c_void_p, c_void_p]
     )
 
     # Output
-    _setsig(_dylib.ireeCompilerOutputDestroy, None, [c_void_p])
-    _setsig(_dylib.ireeCompilerOutputOpenFile, c_void_p, [c_char_p, c_void_p])
-    _setsig(_dylib.ireeCompilerOutputOpenMembuffer, c_void_p, [c_void_p])
-    _setsig(_dylib.ireeCompilerOutputKeep, None, [c_void_p])
+    _setsig(dylib.ireeCompilerOutputDestroy, None, [c_void_p])
+    _setsig(dylib.ireeCompilerOutputOpenFile, c_void_p, [c_char_p, c_void_p])
+    _setsig(dylib.ireeCompilerOutputOpenMembuffer, c_void_p, [c_void_p])
+    _setsig(dylib.ireeCompilerOutputKeep, None, [c_void_p])
     _setsig(
-        _dylib.ireeCompilerOutputWrite, c_void_p, [c_void_p, POINTER(c_char), c_size_t]
+        dylib.ireeCompilerOutputWrite, c_void_p, [c_void_p, POINTER(c_char), c_size_t]
     )
     _setsig(
-        _dylib.ireeCompilerOutputMapMemory,
+        dylib.ireeCompilerOutputMapMemory,
         c_void_p,
         [c_void_p, c_void_p, POINTER(c_uint64)],
     )
 
     # Session
-    _setsig(_dylib.ireeCompilerSessionCreate, c_void_p, [])
-    _setsig(_dylib.ireeCompilerSessionDestroy, None, [c_void_p])
+    _setsig(dylib.ireeCompilerSessionCreate, c_void_p, [])
+    _setsig(dylib.ireeCompilerSessionDestroy, None, [c_void_p])
     _setsig(
-        _dylib.ireeCompilerSessionGetFlags,
+        dylib.ireeCompilerSessionGetFlags,
         None,
         [c_void_p, c_bool, c_void_p, c_void_p],
     )
     _setsig(
-        _dylib.ireeCompilerSessionSetFlags,
+        dylib.ireeCompilerSessionSetFlags,
         c_void_p,
         [c_void_p, c_int, c_void_p],
     )
     # Source
-    _setsig(_dylib.ireeCompilerSourceDestroy, None, [c_void_p])
+    _setsig(dylib.ireeCompilerSourceDestroy, None, [c_void_p])
     _setsig(
-        _dylib.ireeCompilerSourceOpenFile,
+        dylib.ireeCompilerSourceOpenFile,
         c_void_p,
         [
             c_void_p,  # session
@@ -100,7 +157,7 @@ def _init_dylib():
         ],
     )
     _setsig(
-        _dylib.ireeCompilerSourceWrapBuffer,
+        dylib.ireeCompilerSourceWrapBuffer,
         c_void_p,
         [
             c_void_p,  # session
@@ -112,46 +169,77 @@ def _init_dylib():
         ],
     )
 
+    # Bind entry points as module globals so that calls do not go through
+    # attribute lookup on the CDLL.
+    globals().update({name: getattr(dylib, name) for name in _ENTRY_POINTS})
+
+    # Only publish the library once it is fully set up, so that a failed
+    # initialization is retried from scratch.
+    _dylib = dylib
+    _dylib_path = dylib_path
+
+
+def _buffer_arg(buffer):
+    """Adapts a buffer for passing as a POINTER(c_char) argument.
+
+    Returns a tuple of (argument, byte sequence). The argument references the
+    buffer's memory in place unless it is read-only and not bytes, in which
+    case it is a copy. The argument must be kept alive for as long as the
+    callee may access it.
+    """
+    # Fast paths for the common types, which need no memoryview.
+    if isinstance(buffer, bytes):
+        return buffer, buffer
+    if isinstance(buffer, bytearray):
+        return (c_char * len(buffer)).from_buffer(buffer), buffer
+    view = memoryview(buffer)
+    if not view.c_contiguous:
+        raise ValueError("Buffer must be c_contiguous")
+    view = view.cast("B")
+    if view.readonly:
+        return view.tobytes(), view
+    return (c_char * len(view)).from_buffer(view), view
+
 
 def _handle_error(err_p, exc_type=ValueError):
     if err_p is None:
         return
-    message = _dylib.ireeCompilerErrorGetMessage(err_p).decode("UTF-8")
-    _dylib.ireeCompilerErrorDestroy(err_p)
+    message = ireeCompilerErrorGetMessage(err_p).decode("UTF-8")
+    ireeCompilerErrorDestroy(err_p)
     raise exc_type(message)
 
 
 class Session:
     def __init__(self):
-        self._global_init = _global_init
-        self._session_p = _dylib.ireeCompilerSessionCreate()
+        self._session_p = None
+        self._global_init = _get_global_init()
+        self._session_p = ireeCompilerSessionCreate()
 
     def __del__(self):
-        _dylib.ireeCompilerSessionDestroy(self._session_p)
+        if self._session_p and self._global_init.alive:
+            ireeCompilerSessionDestroy(self._session_p)
 
     def invocation(self):
         return Invocation(self)
 
     def get_flags(self, non_default_only: bool = False) -> Sequence[str]:
-        results = []
-
-        @_GET_FLAG_CALLBACK
-        def callback(flag_pointer, length, user_data):
-            flag_bytes = string_at(flag_pointer, length)
-            flag_value = flag_bytes.decode("UTF-8")
-            results.append(flag_value)
+        raw_flags = []
+        _get_flags_tls.results = raw_flags
+        try:
+            ireeCompilerSessionGetFlags(
+                self._session_p, non_default_only, _get_flag_callback, c_void_p(0)
+            )
+        finally:
+            _get_flags_tls.results = None
+        return [flag.decode("UTF-8") for flag in raw_flags]
 
-        _dylib.ireeCompilerSessionGetFlags(
-            self._session_p, non_default_only, callback, c_void_p(0)
-        )
-        return results
+    def get_flags_set(self, non_default_only: bool = False) -> FrozenSet[str]:
+        """Returns the flags as a set, for membership tests."""
+        return frozenset(self.get_flags(non_default_only))
 
     def set_flags(self, *flags: Sequence[str]):
-        argv_type = c_char_p * len(flags)
-        argv = argv_type(*[flag.encode("UTF-8") for flag in flags])
-        _handle_error(
-            _dylib.ireeCompilerSessionSetFlags(self._session_p, len(argv), argv)
-        )
+        argv = _encode_argv(flags)
+        _handle_error(ireeCompilerSessionSetFlags(self._session_p, len(argv), argv))
 
 
 class Output:
@@ -159,48 +247,52 @@ class Output:
 
     def __init__(self, output_p: c_void_p):
         self._output_p = output_p
-        self._local_dylib = _dylib
+        self._global_init = _get_global_init()
 
     def __del__(self):
         self.close()
 
     def close(self):
         if self._output_p:
-            self._local_dylib.ireeCompilerOutputDestroy(self._output_p)
+            if self._global_init.alive:
+                ireeCompilerOutputDestroy(self._output_p)
             self._output_p = None
 
     @staticmethod
     def open_file(file_path: str) -> "Output":
+        _get_global_init()
         output_p = c_void_p()
         _handle_error(
-            _dylib.ireeCompilerOutputOpenFile(file_path.encode(), byref(output_p))
+            ireeCompilerOutputOpenFile(_encode_cached(file_path), byref(output_p))
         )
         return Output(output_p)
 
     @staticmethod
     def open_membuffer() -> "Output":
+        _get_global_init()
         output_p = c_void_p()
-        _handle_error(_dylib.ireeCompilerOutputOpenMembuffer(byref(output_p)))
+        _handle_error(ireeCompilerOutputOpenMembuffer(byref(output_p)))
         return Output(output_p)
 
     def keep(self) -> "Output":
-        _dylib.ireeCompilerOutputKeep(self._output_p)
+        ireeCompilerOutputKeep(self._output_p)
 
     def write(self, buffer):
-        _handle_error(
-            _dylib.ireeCompilerOutputWrite(self._output_p, buffer, len(buffer))
-        )
+        buffer_arg, view = _buffer_arg(buffer)
+        _handle_error(ireeCompilerOutputWrite(self._output_p, buffer_arg, len(view)))
 
     def map_memory(self) -> memoryview:
+        """Returns a byte view of the output, without copying.
+
+        The view compares equal to bytes objects with the same contents.
+        """
         contents = c_void_p()
         size = c_uint64()
         _handle_error(
-            _dylib.ireeCompilerOutputMapMemory(
-                self._output_p, byref(contents), byref(size)
-            )
+            ireeCompilerOutputMapMemory(self._output_p, byref(contents), byref(size))
         )
         size = size.value
-        return memoryview((c_char * size).from_address(contents.value))
+        return memoryview((c_char * size).from_address(contents.value)).cast("B")
 
 
 class Source:
@@ -210,7 +302,7 @@ class Source:
         self._session: c_void_p = session  # Keeps ref alive.
         self._source_p: c_void_p = source_p
         self._backing_ref = backing_ref
-        self._local_dylib = _dylib
+        self._global_init = _get_global_init()
 
     def __del__(self):
         self.close()
@@ -219,7 +311,8 @@ class Source:
         if self._source_p:
             s = self._source_p
             self._source_p = c_void_p()
-            self._local_dylib.ireeCompilerSourceDestroy(s)
+            if self._global_init.alive:
+                ireeCompilerSourceDestroy(s)
             self._backing_ref = None
             self._session = c_void_p()
 
@@ -228,10 +321,11 @@ class Source:
 
     @staticmethod
     def open_file(session: Session, file_path: str) -> "Source":
+        _get_global_init()
         source_p = c_void_p()
         _handle_error(
-            _dylib.ireeCompilerSourceOpenFile(
-                session._session_p, file_path.encode(), byref(source_p)
+            ireeCompilerSourceOpenFile(
+                session._session_p, _encode_cached(file_path), byref(source_p)
             )
         )
         return Source(session, source_p, None)
@@ -240,23 +334,22 @@ class Source:
     def wrap_buffer(
         session: Session, buffer, *, buffer_name: Optional[str] = None
     ) -> "Source":
-        view = memoryview(buffer)
-        if not view.c_contiguous:
-            raise ValueError("Buffer must be c_contiguous")
+        _get_global_init()
+        buffer_arg, view = _buffer_arg(buffer)
         source_p = c_void_p()
-        buffer_len = len(buffer)
+        buffer_len = len(view)
         _handle_error(
-            _dylib.ireeCompilerSourceWrapBuffer(
+            ireeCompilerSourceWrapBuffer(
                 session._session_p,
-                buffer_name.encode(),
-                buffer,
+                _encode_cached(buffer_name),
+                buffer_arg,
                 buffer_len,
                 # Detect if nul terminated.
                 True if buffer_len > 0 and view[-1] == 0 else False,
                 byref(source_p),
             )
         )
-        return Source(session, source_p, buffer)
+        return Source(session, source_p, buffer_arg)
 
 
 class PipelineType(IntEnum):
@@ -266,46 +359,124 @@ class PipelineType(IntEnum):
 
 class Invocation:
     def __init__(self, session: Session):
+        self._inv_p = None
+        self._global_init = _get_global_init()
         self._session = session
-        self._inv_p = _dylib.ireeCompilerInvocationCreate(self._session._session_p)
+        self._inv_p = ireeCompilerInvocationCreate(self._session._session_p)
+        # Sources parsed into this invocation must outlive it. They are only
+        # referenced (not owned), so a source may be shared by invocations and
+        # is destroyed when its last reference is dropped.
         self._sources: List[Source] = []
-        self._local_dylib = _dylib
 
     def __del__(self):
         self.close()
 
     def close(self):
         if self._inv_p:
-            self._local_dylib.ireeCompilerInvocationDestroy(self._inv_p)
+            if self._global_init.alive:
+                ireeCompilerInvocationDestroy(self._inv_p)
             self._inv_p = c_void_p()
-            for s in self._sources:
-                s.close()
             self._sources.clear()
 
     def enable_console_diagnostics(self):
-        _dylib.ireeCompilerInvocationEnableConsoleDiagnostics(self._inv_p)
+        ireeCompilerInvocationEnableConsoleDiagnostics(self._inv_p)
 
     def parse_source(self, source: Source) -> bool:
         self._sources.append(source)
-        return _dylib.ireeCompilerInvocationParseSource(self._inv_p, source._source_p)
+        return ireeCompilerInvocationParseSource(self._inv_p, source._source_p)
 
     def execute(
         self, pipeline: PipelineType = PipelineType.IREE_COMPILER_PIPELINE_STD
     ) -> bool:
-        return _dylib.ireeCompilerInvocationPipeline(self._inv_p, pipeline)
+        # Runs without the GIL held (see _init_dylib).
+        return ireeCompilerInvocationPipeline(self._inv_p, pipeline)
 
     def output_ir(self, output: Output):
-        _handle_error(
-            _dylib.ireeCompilerInvocationOutputIR(self._inv_p, output._output_p)
-        )
+        _handle_error(ireeCompilerInvocationOutputIR(self._inv_p, output._output_p))
 
     def output_vm_bytecode(self, output: Output):
         _handle_error(
-            _dylib.ireeCompilerInvocationOutputVMBytecode(self._inv_p, output._output_p)
+            ireeCompilerInvocationOutputVMBytecode(self._inv_p, output._output_p)
         )
 
 
 def _probe_iree_compiler_dylib() -> str:
+    """Locates the compiler dylib.
+
+    An explicit IREE_COMPILER_DYLIB environment variable takes precedence.
+    Otherwise, the result of a prior probe for this interpreter is read from
+    the user cache directory, falling back to probing the installed
+    iree.compiler package (which is expensive to import). A cached result is
+    only used if it was probed from the iree.compiler package that the
+    current sys.path would import.
+    """
+    env_path = os.environ.get("IREE_COMPILER_DYLIB")
+    if env_path:
+        if not os.path.isfile(env_path):
+            raise ValueError(f"IREE_COMPILER_DYLIB={env_path} does not exist")
+        return env_path
+
+    cache_file = _get_probe_cache_file()
+    mlir_libs_dir = _find_mlir_libs_dir()
+    try:
+        with open(cache_file, "r") as f:
+            cached_mlir_libs_dir, cached_path = f.read().split("\n", 1)
+        if cached_mlir_libs_dir == mlir_libs_dir and os.path.isfile(cached_path):
+            logging.debug("Using cached --iree-compiler-dylib=%s", cached_path)
+            return cached_path
+    except (OSError, ValueError):
+        pass
+
+    dylib_path = _probe_installed_iree_compiler_dylib()
+    if mlir_libs_dir is None:
+        # Not importable from a plain directory (e.g. a zip); cannot validate.
+        return dylib_path
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{mlir_libs_dir}\n{dylib_path}")
+            os.replace(tmp_path, cache_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logging.debug("Could not cache compiler dylib path: %s", e)
+    return dylib_path
+
+
+def get_cache_dir() -> str:
+    """Returns the per-user cache directory for this package."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "shark-engine")
+
+
+def _get_probe_cache_file() -> str:
+    key = hashlib.sha256(
+        f"{sys.prefix}\0{platform.system()}\0{platform.machine()}".encode()
+    ).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), f"dylib_path_{key}")
+
+
+def _find_mlir_libs_dir() -> Optional[str]:
+    """Finds the iree.compiler._mlir_libs directory on sys.path.
+
+    This is the directory that importing iree.compiler would use, found
+    without importing it.
+    """
+    for entry in sys.path:
+        mlir_libs_dir = os.path.join(
+            entry or os.curdir, "iree", "compiler", "_mlir_libs"
+        )
+        if os.path.isdir(mlir_libs_dir):
+            return os.path.abspath(mlir_libs_dir)
+    return None
+
+
+def _probe_installed_iree_compiler_dylib() -> str:
     """Probes an installed iree.compiler for the compiler dylib."""
     # TODO: Make this an API on iree.compiler itself. Burn this with fire.
     from iree.compiler import _mlir_libs
@@ -323,8 +494,9 @@ def _probe_iree_compiler_dylib() -> str:
     if dev_mode and len(_mlir_libs.__path__) == 1:
         # Track up the to the build dir and into the lib. Burn this with more fire.
         paths = [
-            Path(_mlir_libs.__path__[0]).parent.parent.parent.parent.parent.parent
-            / "lib"
+            os.path.normpath(
+                os.path.join(_mlir_libs.__path__[0], *([os.pardir] * 6), "lib")
+            )
         ]
     else:
         paths = _mlir_libs.__path__
@@ -338,24 +510,61 @@ def _probe_iree_compiler_dylib() -> str:
         dylib_basename = "IREECompiler.dll"
 
     for p in paths:
-        dylib_path = Path(p) / dylib_basename
-        if dylib_path.exists():
+        dylib_path = os.path.join(p, dylib_basename)
+        if os.path.isfile(dylib_path):
             logging.debug("Found --iree-compiler-dylib=%s", dylib_path)
             return dylib_path
     raise ValueError(f"Could not find {dylib_basename} in {paths}")
 
 
 class _GlobalInit:
-    def __init__(self):
-        _init_dylib()
-        # Cache locally so as to not have it go out of scope first
-        # during shutdown.
-        self.local_dylib = _dylib
-        self.local_dylib.ireeCompilerGlobalInitialize()
+    """Process-wide compiler initialization.
 
-    def __del__(self):
-        self.local_dylib.ireeCompilerGlobalShutdown()
+    Shutdown runs from atexit, while the interpreter and ctypes are still
+    fully alive, rather than from a finalizer. Handles that are destroyed
+    after that point (i.e. during interpreter finalization) are leaked
+    instead of being passed back to the shut down library.
+    """
 
-
-# Keep one reference for the life of the module.
-_global_init = _GlobalInit()
+    def __init__(self):
+        _init_dylib()
+        ireeCompilerGlobalInitialize()
+        self.alive = True
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        if self.alive:
+            self.alive = False
+            ireeCompilerGlobalShutdown()
+
+
+_global_init: Optional[_GlobalInit] = None
+_global_init_lock = threading.Lock()
+
+
+def _get_global_init() -> _GlobalInit:
+    """Loads and initializes the compiler on first use.
+
+    Keeps one reference for the life of the module. Only the one-time
+    initialization is serialized; subsequent calls do not take the lock.
+    Raises RuntimeError once the compiler has been shut down.
+    """
+    global _global_init
+    if _global_init is None:
+        with _global_init_lock:
+            if _global_init is None:
+                _global_init = _GlobalInit()
+    if not _global_init.alive:
+        raise RuntimeError("The IREE compiler has been shut down")
+    return _global_init
+
+
+def get_dylib_path() -> str:
+    """Returns the path of the compiler dylib.
+
+    This does not load the library: if it is not yet loaded, the path that
+    would be loaded is probed (which is usually served from the probe cache).
+    """
+    if _dylib_path is not None:
+        return _dylib_path
+    return _probe_iree_compiler_dylib()
@@ -0,0 +1,123 @@
+# Copyright 2023 Stella Laurenzo
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+from unittest import mock
+import os
+import tempfile
+import threading
+import unittest
+
+from shark_engine.dynamo import executor
+from shark_engine.support.compile_cache import CompileCache
+
+
+class GetCompilerTest(unittest.TestCase):
+    def setUp(self):
+        # Each call to the mocked Compiler() constructs a distinct instance.
+        patches = [
+            mock.patch.object(executor, "Compiler", side_effect=lambda: mock.Mock()),
+            mock.patch.object(executor, "_compilers_tls", threading.local()),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def testReusedForSameFlags(self):
+        compiler = executor._get_compiler(("--a",))
+        compiler.set_flags.assert_called_once_with("--a")
+        self.assertIs(compiler, executor._get_compiler(("--a",)))
+        self.assertIsNot(compiler, executor._get_compiler(("--b",)))
+        self.assertEqual(2, executor.Compiler.call_count)
+
+    def testPerThread(self):
+        compiler = executor._get_compiler(("--a",))
+        other_thread_compilers = []
+        t = threading.Thread(
+            target=lambda: other_thread_compilers.append(
+                executor._get_compiler(("--a",))
+            )
+        )
+        t.start()
+        t.join()
+        self.assertEqual(1, len(other_thread_compilers))
+        self.assertIsNot(compiler, other_thread_compilers[0])
+        self.assertIs(compiler, executor._get_compiler(("--a",)))
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.assertEqual(4, executor._MAX_COMPILERS_PER_THREAD)
+        compilers = {
+            flag: executor._get_compiler((flag,)) for flag in ("--a", "--b", "--c")
+        }
+        compilers["--d"] = executor._get_compiler(("--d",))
+        # Makes "--a" the most recently used, leaving "--b" the least.
+        self.assertIs(compilers["--a"], executor._get_compiler(("--a",)))
+        executor._get_compiler(("--e",))
+        for flag in ("--a", "--c", "--d"):
+            self.assertIs(compilers[flag], executor._get_compiler((flag,)))
+        self.assertIsNot(compilers["--b"], executor._get_compiler(("--b",)))
+
+
+class CompileCacheTest(unittest.TestCase):
+    """Tests JittableExecutable's use of the compile cache.
+
+    The compiler and runtime are mocked: only the cache hit/miss routing is
+    under test.
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = CompileCache(os.path.join(tmp.name, "bytecode"))
+        self.compiler = mock.Mock()
+        vmfb_output = self.compiler.open_output_membuffer.return_value
+        vmfb_output.map_memory.return_value = memoryview(b"vmfb")
+        self.rt = mock.Mock()
+        patches = [
+            mock.patch.object(executor, "rt", self.rt),
+            mock.patch.object(executor, "SpecializedExecutable"),
+            mock.patch.object(executor, "get_toolchain_salt", return_value="salt"),
+            mock.patch.object(
+                executor, "get_default_compile_cache", return_value=self.cache
+            ),
+            mock.patch.object(executor, "_get_compiler", return_value=self.compiler),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def createExecutable(self):
+        return executor.JittableExecutable(
+            executor.InputModule(b"module {}"),
+            mock.Mock(),
+            compiler_flags=("--iree-hal-target-backends=vmvx",),
+        )
+
+    def testMissCompilesAndStores(self):
+        self.createExecutable()
+        self.compiler.load_buffer.return_value.execute.assert_called_once_with()
+        self.assertEqual(1, len(os.listdir(self.cache.cache_dir)))
+        vmfb_contents = self.rt.VmModule.wrap_buffer.call_args[0][1]
+        self.assertEqual(b"vmfb", vmfb_contents)
+
+    def testHitSkipsCompiler(self):
+        self.createExecutable()
+        self.compiler.reset_mock()
+        self.rt.reset_mock()
+        self.createExecutable()
+        self.compiler.load_buffer.assert_not_called()
+        vmfb_contents = self.rt.VmModule.wrap_buffer.call_args[0][1]
+        self.assertEqual(b"vmfb", vmfb_contents[:])
+
+    def testDisabled(self):
+        executor.get_default_compile_cache.return_value = None
+        self.createExecutable()
+        self.createExecutable()
+        self.assertEqual(2, self.compiler.load_buffer.call_count)
+        self.assertFalse(os.path.exists(self.cache.cache_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
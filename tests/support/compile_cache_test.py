@@ -0,0 +1,114 @@
+# Copyright 2023 Stella Laurenzo
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+from unittest import mock
+import os
+import tempfile
+import unittest
+
+from shark_engine.support import compile_cache
+from shark_engine.support import compiler_dl as dl
+from shark_engine.support.compile_cache import *
+
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.cache = CompileCache(os.path.join(self._tmp.name, "bytecode"))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def testKeyDependsOnInputs(self):
+        key = CompileCache.make_key(b"module {}", ["--a"], "salt")
+        self.assertEqual(key, CompileCache.make_key(b"module {}", ["--a"], "salt"))
+        self.assertNotEqual(key, CompileCache.make_key(b"module {} ", ["--a"], "salt"))
+        self.assertNotEqual(key, CompileCache.make_key(b"module {}", ["--b"], "salt"))
+        self.assertNotEqual(key, CompileCache.make_key(b"module {}", ["--a"], "other"))
+        self.assertNotEqual(
+            CompileCache.make_key(b"", ["--a", "b"], "salt"),
+            CompileCache.make_key(b"", ["--ab"], "salt"),
+        )
+
+    def testMiss(self):
+        self.assertIsNone(self.cache.lookup("0" * 64))
+
+    def testStoreLookup(self):
+        self.assertTrue(self.cache.store("abc", memoryview(b"foobar")))
+        mapping = self.cache.lookup("abc")
+        self.assertIsNotNone(mapping)
+        try:
+            self.assertEqual(b"foobar", mapping[:])
+        finally:
+            mapping.close()
+        self.assertEqual(["abc.vmfb"], os.listdir(self.cache.cache_dir))
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = CompileCache(self.cache.cache_dir, max_size=8)
+        cache.store("a", b"aaaa")
+        cache.store("b", b"bbbb")
+        os.utime(cache.get_path("a"), ns=(1, 1))
+        os.utime(cache.get_path("b"), ns=(2, 2))
+        # Looking up "a" makes it the most recently used.
+        cache.lookup("a").close()
+        cache.store("c", b"cccc")
+        self.assertEqual(["a.vmfb", "c.vmfb"], sorted(os.listdir(cache.cache_dir)))
+
+    def testNeverEvictsNewEntry(self):
+        cache = CompileCache(self.cache.cache_dir, max_size=8)
+        cache.store("a", b"aaaa")
+        cache.store("b", b"bbbb")
+        # Make the existing entries look newer than anything written next, as
+        # can happen with coarse filesystem timestamps.
+        future_ns = (2**40) * 10**9
+        for key in ("a", "b"):
+            os.utime(cache.get_path(key), ns=(future_ns, future_ns))
+        self.assertTrue(cache.store("c", b"cccc"))
+        self.assertIsNotNone(cache.lookup("c"))
+        self.assertEqual(2, len(os.listdir(cache.cache_dir)))
+
+    def testOversizedEntryIsNotStored(self):
+        cache = CompileCache(self.cache.cache_dir, max_size=4)
+        self.assertFalse(cache.store("abc", b"0123456789"))
+        self.assertIsNone(cache.lookup("abc"))
+        self.assertTrue(cache.store("def", b"0123"))
+        self.assertEqual(["def.vmfb"], os.listdir(cache.cache_dir))
+
+    def testRemovesStaleTemporaryFiles(self):
+        os.makedirs(self.cache.cache_dir)
+        stale_path = os.path.join(self.cache.cache_dir, "stale.tmp")
+        fresh_path = os.path.join(self.cache.cache_dir, "fresh.tmp")
+        for path in (stale_path, fresh_path):
+            with open(path, "wb") as f:
+                f.write(b"partial")
+        os.utime(stale_path, ns=(1, 1))
+        self.cache.store("abc", b"foobar")
+        self.assertEqual(
+            ["abc.vmfb", "fresh.tmp"], sorted(os.listdir(self.cache.cache_dir))
+        )
+
+    def testEmptyEntryIsMiss(self):
+        self.cache.store("abc", b"")
+        self.assertIsNone(self.cache.lookup("abc"))
+
+
+class ToolchainSaltTest(unittest.TestCase):
+    def setUp(self):
+        compile_cache.get_toolchain_salt.cache_clear()
+        self.addCleanup(compile_cache.get_toolchain_salt.cache_clear)
+
+    def testDoesNotLoadCompiler(self):
+        with tempfile.NamedTemporaryFile() as dylib, mock.patch.object(
+            dl, "_probe_iree_compiler_dylib", return_value=dylib.name
+        ), mock.patch.object(dl, "_dylib_path", None), mock.patch.object(
+            dl, "_get_global_init", side_effect=AssertionError("loaded")
+        ):
+            salt = compile_cache.get_toolchain_salt()
+        self.assertTrue(salt.startswith(dylib.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
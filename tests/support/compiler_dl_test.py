@@ -0,0 +1,184 @@
+# Copyright 2023 Stella Laurenzo
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+# Tests of compiler_dl internals which do not require libIREECompiler.
+
+from ctypes import POINTER, c_char
+from unittest import mock
+import array
+import os
+import sys
+import tempfile
+import unittest
+
+from shark_engine.support import compiler_dl as dl
+
+
+class GlobalInitTest(unittest.TestCase):
+    def testUseAfterShutdownRaises(self):
+        # An already initialized instance, without loading the library.
+        global_init = object.__new__(dl._GlobalInit)
+        global_init.alive = True
+        shutdown = mock.Mock()
+        with mock.patch.object(
+            dl, "ireeCompilerGlobalShutdown", shutdown, create=True
+        ), mock.patch.object(dl, "_global_init", global_init):
+            global_init.shutdown()
+            global_init.shutdown()
+            shutdown.assert_called_once_with()
+            with self.assertRaises(RuntimeError):
+                dl.Session()
+            with self.assertRaises(RuntimeError):
+                dl.Output.open_membuffer()
+
+
+class InitDylibTest(unittest.TestCase):
+    def testRetryAfterFailedInit(self):
+        # Lacks every entry point, like loading the wrong library.
+        incomplete = mock.Mock(spec=[])
+        complete = mock.Mock()
+        load_library = mock.Mock(side_effect=[incomplete, complete])
+        # Restores the module state (and entry point globals) afterwards.
+        with mock.patch.dict(dl.__dict__), mock.patch.object(
+            dl, "_probe_iree_compiler_dylib", return_value="stub.so"
+        ), mock.patch.object(dl.cdll, "LoadLibrary", load_library):
+            dl._dylib = None
+            dl._dylib_path = None
+            with self.assertRaises(AttributeError):
+                dl._init_dylib()
+            self.assertIsNone(dl._dylib)
+            self.assertIsNone(dl._dylib_path)
+
+            dl._init_dylib()
+            self.assertIs(complete, dl._dylib)
+            self.assertEqual("stub.so", dl._dylib_path)
+            self.assertIs(
+                complete.ireeCompilerGlobalInitialize,
+                dl.ireeCompilerGlobalInitialize,
+            )
+
+
+class ProbeDylibTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dylib_path = os.path.join(tmp.name, "libIREECompiler.so")
+        open(self.dylib_path, "wb").close()
+        env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmp.name})
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop("IREE_COMPILER_DYLIB", None)
+        # Two site directories, each providing an iree.compiler package.
+        self.site_a = os.path.join(tmp.name, "site_a")
+        self.site_b = os.path.join(tmp.name, "site_b")
+        for site in (self.site_a, self.site_b):
+            os.makedirs(os.path.join(site, "iree", "compiler", "_mlir_libs"))
+        path = mock.patch.object(sys, "path", [self.site_a])
+        path.start()
+        self.addCleanup(path.stop)
+
+    def patchProbe(self, **kwargs):
+        return mock.patch.object(dl, "_probe_installed_iree_compiler_dylib", **kwargs)
+
+    def testEnvOverride(self):
+        os.environ["IREE_COMPILER_DYLIB"] = self.dylib_path
+        with self.patchProbe(side_effect=AssertionError("probed")):
+            self.assertEqual(self.dylib_path, dl._probe_iree_compiler_dylib())
+
+    def testEnvOverrideMissing(self):
+        os.environ["IREE_COMPILER_DYLIB"] = self.dylib_path + ".missing"
+        with self.assertRaises(ValueError):
+            dl._probe_iree_compiler_dylib()
+
+    def testCachedProbe(self):
+        with self.patchProbe(return_value=self.dylib_path) as probe:
+            self.assertEqual(self.dylib_path, dl._probe_iree_compiler_dylib())
+            probe.assert_called_once_with()
+        self.assertTrue(dl._get_probe_cache_file().startswith(dl.get_cache_dir()))
+        self.assertEqual(
+            [os.path.basename(dl._get_probe_cache_file())],
+            os.listdir(dl.get_cache_dir()),
+        )
+        with self.patchProbe(side_effect=AssertionError("probed")):
+            self.assertEqual(self.dylib_path, dl._probe_iree_compiler_dylib())
+
+    def testCacheSharedAcrossScriptDirs(self):
+        with self.patchProbe(return_value=self.dylib_path):
+            dl._probe_iree_compiler_dylib()
+        # A different sys.path[0], which does not provide iree.compiler.
+        with mock.patch.object(sys, "path", ["/some/script/dir", self.site_a]):
+            with self.patchProbe(side_effect=AssertionError("probed")):
+                self.assertEqual(self.dylib_path, dl._probe_iree_compiler_dylib())
+        self.assertEqual(1, len(os.listdir(dl.get_cache_dir())))
+
+    def testCacheInvalidatedByOtherIreeCompiler(self):
+        with self.patchProbe(return_value=self.dylib_path):
+            dl._probe_iree_compiler_dylib()
+        # A dev build put ahead of the installed package on PYTHONPATH.
+        with mock.patch.object(sys, "path", [self.site_b, self.site_a]):
+            with self.patchProbe(return_value="/dev/libIREECompiler.so") as probe:
+                self.assertEqual(
+                    "/dev/libIREECompiler.so", dl._probe_iree_compiler_dylib()
+                )
+                probe.assert_called_once_with()
+
+    def testStaleCacheIsReprobed(self):
+        with self.patchProbe(return_value=self.dylib_path):
+            dl._probe_iree_compiler_dylib()
+        os.unlink(self.dylib_path)
+        with self.patchProbe(return_value="/other/libIREECompiler.so") as probe:
+            self.assertEqual(
+                "/other/libIREECompiler.so", dl._probe_iree_compiler_dylib()
+            )
+            probe.assert_called_once_with()
+
+
+class BufferArgTest(unittest.TestCase):
+    def assertPassable(self, arg):
+        # Raises if ctypes cannot pass `arg` as a char pointer.
+        POINTER(c_char).from_param(arg)
+
+    def testBytes(self):
+        buffer = b"foo\0"
+        arg, view = dl._buffer_arg(buffer)
+        self.assertIs(arg, buffer)
+        self.assertEqual(0, view[-1])
+
+    def testBytearrayIsNotCopied(self):
+        buffer = bytearray(b"foo\0")
+        arg, view = dl._buffer_arg(buffer)
+        self.assertPassable(arg)
+        buffer[0] = ord("g")
+        self.assertEqual(b"goo\0", bytes(arg))
+        self.assertEqual(0, view[-1])
+
+    def testWritableMemoryviewIsNotCopied(self):
+        buffer = bytearray(b"foo\0")
+        arg, view = dl._buffer_arg(memoryview(buffer))
+        self.assertPassable(arg)
+        buffer[0] = ord("g")
+        self.assertEqual(b"goo\0", bytes(arg))
+        self.assertEqual(0, view[-1])
+
+    def testReadOnlyBufferIsCopied(self):
+        arg, view = dl._buffer_arg(memoryview(b"foo\0"))
+        self.assertPassable(arg)
+        self.assertEqual(b"foo\0", arg)
+        self.assertEqual(0, view[-1])
+
+    def testLengthIsInBytes(self):
+        buffer = array.array("i", [1, 2, 3])
+        arg, view = dl._buffer_arg(buffer)
+        self.assertPassable(arg)
+        self.assertEqual(3 * buffer.itemsize, len(view))
+
+    def testNonContiguousRaises(self):
+        with self.assertRaises(ValueError):
+            dl._buffer_arg(memoryview(b"foobar")[::2])
+
+
+if __name__ == "__main__":
+    unittest.main()
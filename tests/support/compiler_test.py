@@ -8,18 +8,27 @@
 
 from contextlib import closing
 from pathlib import Path
+import array
+import os
 import tempfile
 import unittest
 
 from shark_engine.support.compiler_dl import *
 from shark_engine.support.compiler_api import *
 
+_EMPTY_MODULE_BYTES = b"module {}"
+
+# Sessions and compilers are expensive to create, so tests that do not mutate
+# session state share a per-class instance.
+
 
 class DlFlagsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._session = Session()
+
     def testDefaultFlags(self):
-        session = Session()
-        flags = session.get_flags()
-        print(flags)
+        flags = self._session.get_flags_set()
         self.assertIn("--iree-input-type=auto", flags)
 
     def testNonDefaultFlags(self):
@@ -27,7 +36,7 @@ class DlFlagsTest(unittest.TestCase):
         flags = session.get_flags(non_default_only=True)
         self.assertEqual(flags, [])
         session.set_flags("--iree-input-type=none")
-        flags = session.get_flags(non_default_only=True)
+        flags = session.get_flags_set(non_default_only=True)
         self.assertIn("--iree-input-type=none", flags)
 
     def testFlagsAreScopedToSession(self):
@@ -35,8 +44,8 @@ class DlFlagsTest(unittest.TestCase):
         session2 = Session()
         session1.set_flags("--iree-input-type=tosa")
         session2.set_flags("--iree-input-type=none")
-        self.assertIn("--iree-input-type=tosa", session1.get_flags())
-        self.assertIn("--iree-input-type=none", session2.get_flags())
+        self.assertIn("--iree-input-type=tosa", session1.get_flags_set())
+        self.assertIn("--iree-input-type=none", session2.get_flags_set())
 
     def testFlagError(self):
         session = Session()
@@ -45,12 +54,30 @@ class DlFlagsTest(unittest.TestCase):
 
 
 class DlInvocationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._session = Session()
+
     def testCreate(self):
-        session = Session()
-        inv = session.invocation()
+        inv = self._session.invocation()
+
+    def testParseNulTerminatedBuffer(self):
+        source = Source.wrap_buffer(
+            self._session, bytearray(_EMPTY_MODULE_BYTES + b"\0"), buffer_name="foobar"
+        )
+        inv = self._session.invocation()
+        self.assertTrue(inv.parse_source(source))
 
 
 class DlOutputTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
     def testOpenMembuffer(self):
         out = Output.open_membuffer()
 
@@ -62,11 +89,30 @@ class DlOutputTest(unittest.TestCase):
         out = Output.open_membuffer()
         out.write(b"foobar")
         mem = out.map_memory()
-        self.assertEqual(b"foobar", bytes(mem))
+        self.assertEqual(b"foobar", mem)
         out.close()
 
+    def testOpenMembufferWriteBytearray(self):
+        with closing(Output.open_membuffer()) as out:
+            out.write(bytearray(b"foobar"))
+            self.assertEqual(b"foobar", out.map_memory())
+
+    def testOpenMembufferWriteMemoryview(self):
+        with closing(Output.open_membuffer()) as out:
+            # Read-only, so written from a copy.
+            out.write(memoryview(b"foobar"))
+            self.assertEqual(b"foobar", out.map_memory())
+
+    def testOpenMembufferWriteMultiByteElements(self):
+        contents = array.array("i", [1, 2, 3])
+        with closing(Output.open_membuffer()) as out:
+            out.write(contents)
+            mem = out.map_memory()
+            self.assertEqual(3 * contents.itemsize, len(mem))
+            self.assertEqual(contents.tobytes(), mem)
+
     def testOpenFileNoKeep(self):
-        file_path = tempfile.mktemp()
+        file_path = os.path.join(self._tmp.name, "no_keep.out")
         out = Output.open_file(file_path)
         try:
             out.write(b"foobar")
@@ -77,55 +123,56 @@ class DlOutputTest(unittest.TestCase):
         self.assertFalse(Path(file_path).exists())
 
     def testOpenFileKeep(self):
-        file_path = tempfile.mktemp()
+        file_path = os.path.join(self._tmp.name, "keep.out")
         out = Output.open_file(file_path)
         try:
-            try:
-                out.write(b"foobar")
-                out.keep()
-            finally:
-                out.close()
-                # Didn't call keep, so should be deleted.
-
-            with open(file_path, "rb") as f:
-                contents = f.read()
-                self.assertEqual(b"foobar", contents)
+            out.write(b"foobar")
+            out.keep()
         finally:
-            Path(file_path).unlink()
+            out.close()
+
+        with open(file_path, "rb") as f:
+            contents = f.read()
+            self.assertEqual(b"foobar", contents)
 
 
 class CompilerAPITest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._compiler = Compiler()
+
     def testCreate(self):
         compiler = Compiler()
 
     def testLoadFromBytes(self):
-        compiler = Compiler()
-        p = compiler.load_buffer("module {}".encode(), buffer_name="foobar")
+        p = self._compiler.load_buffer(_EMPTY_MODULE_BYTES, buffer_name="foobar")
 
     def testPipelineClose(self):
-        compiler = Compiler()
-        p = compiler.load_buffer("module {}".encode(), buffer_name="foobar")
+        p = self._compiler.load_buffer(_EMPTY_MODULE_BYTES, buffer_name="foobar")
         p.close()
 
     def testLoadFromFile(self):
-        compiler = Compiler()
-        with tempfile.NamedTemporaryFile("w", delete=False) as tf:
-            tf.write("module {}")
-            tf.close()
-            p = compiler.load_file(tf.name)
+        fd, file_path = tempfile.mkstemp(suffix=".mlir")
+        try:
+            os.write(fd, _EMPTY_MODULE_BYTES)
+        finally:
+            os.close(fd)
+        try:
+            p = self._compiler.load_file(file_path)
             p.close()
+        finally:
+            os.unlink(file_path)
 
     def testExecuteIR(self):
-        compiler = Compiler()
-        p = compiler.load_buffer("module {}".encode(), buffer_name="foobar")
+        p = self._compiler.load_buffer(_EMPTY_MODULE_BYTES, buffer_name="foobar")
         p.execute()
-        with closing(compiler.open_output_membuffer()) as output:
+        with closing(self._compiler.open_output_membuffer()) as output:
             p.output_ir(output)
-            ir_contents = bytes(output.map_memory())
-            print(ir_contents)
+            ir_contents = output.map_memory()
             self.assertEqual(b"module {\n}", ir_contents)
 
     def testExecuteVMFB(self):
+        # Sets flags, so needs its own compiler.
         compiler = Compiler()
         compiler.set_flags("--iree-hal-target-backends=vmvx")
         p = compiler.load_buffer(
@@ -135,8 +182,7 @@ class CompilerAPITest(unittest.TestCase):
         p.execute()
         with closing(compiler.open_output_membuffer()) as output:
             p.output_vm_bytecode(output)
-            ir_contents = bytes(output.map_memory())
-            print(len(ir_contents))
+            ir_contents = output.map_memory()
             self.assertGreater(len(ir_contents), 0)
 
 